@@ -1,50 +1,121 @@
 import httpx
-import json
+import logging
+import numpy as np
+import orjson
 import os
 import asyncio
+import time
+from typing import Annotated
 from contextlib import asynccontextmanager
 from http import HTTPStatus
-from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import Field, field_validator
+from pydantic_settings import BaseSettings, NoDecode, SettingsConfigDict
 from telegram import Update
-from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, filters
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, ContextTypes, CommandHandler, MessageHandler, PrefixHandler, filters
 
-# Load environment variables
-load_dotenv()
-TELEGRAM_BOT_TOKEN: str = os.getenv('TELEGRAM_BOT_TOKEN')
+FEATURE_NAMES = frozenset({"portfolio", "market", "profit"})
+
+
+class Settings(BaseSettings):
+    """ Environment configuration, read from the environment and .env once at startup. """
+    model_config = SettingsConfigDict(env_file=".env", extra="ignore")
+
+    telegram_bot_token: str
+    webhook_domain: str = Field(validation_alias="RAILWAY_PUBLIC_DOMAIN")
+    cmc_api_key: str = Field(validation_alias="COINMARKETCAP_API_KEY")
+    # Включённые команды бота, например FEATURES=market,profit (по умолчанию все)
+    features: Annotated[frozenset[str], NoDecode] = FEATURE_NAMES
+
+    @field_validator("features", mode="before")
+    @classmethod
+    def _parse_features(cls, value):
+        if isinstance(value, str):
+            value = {feature.strip() for feature in value.split(",") if feature.strip()}
+        unknown = set(value) - FEATURE_NAMES
+        if unknown:
+            raise ValueError(f"unknown features: {', '.join(sorted(unknown))}")
+        return frozenset(value)
+
+
+logger = logging.getLogger(__name__)
+
+# Load environment variables; fails fast if a required one is missing
+settings = Settings()
 OWNER_ID = 553994132  # Здесь позже сохраним твой chat_id
-WEBHOOK_DOMAIN: str = os.getenv('RAILWAY_PUBLIC_DOMAIN')
+_CMC_HEADERS = {
+    "Accepts": "application/json",
+    "X-CMC_PRO_API_KEY": settings.cmc_api_key
+}
+PORTFOLIO_PATH = "portfolio.json"
+
+# Кэш портфеля: файл перечитывается только при изменении mtime
+_PORTFOLIO_CACHE = {"mtime": 0, "data": None, "rendered": None}
+
+# Кэш цен: не чаще одного запроса к CoinMarketCap за PRICE_TTL секунд
+PRICE_TTL = 45
+SYMBOLS = ("BTC", "ETH", "SOL", "ARB", "TON")
+_PRICE_CACHE = {"ts": 0.0, "data": None, "task": None}
+
+# Статичные ответы собираются один раз при импорте
+_NFT_REPLY = "🖼 NFT-пульс: VALA в портфеле. Следим за Rogues Dead"
+_MARKET_TEMPLATE = "\n".join(["📊 Актуальные курсы:", *(f"{s}: ${{{s}}}" for s in SYMBOLS)])
+
+# At most this many queued updates are handled at once; each handler holds one
+# outbound connection at a time, so the pool is sized to match
+CONCURRENT_UPDATES = 32
 
 # Build the Telegram Bot application
 bot_builder = (
     Application.builder()
-    .token(TELEGRAM_BOT_TOKEN)
+    .token(settings.telegram_bot_token)
     .updater(None)
+    .concurrent_updates(CONCURRENT_UPDATES)
+    .request(HTTPXRequest(connection_pool_size=CONCURRENT_UPDATES, http_version="2"))
     .build()
 )
 
 
 @asynccontextmanager
-async def lifespan(_: FastAPI):
+async def lifespan(app: FastAPI):
     """ Sets the webhook for the Telegram Bot and manages its lifecycle (start/stop). """
-    await bot_builder.bot.setWebhook(url=WEBHOOK_DOMAIN)
-    async with bot_builder:
-        await bot_builder.start()
-        yield
-        await bot_builder.stop()
-        await bot_builder.bot.send_message(chat_id=OWNER_ID, text="✅ Уведомления активны!")
+    # One keep-alive HTTP/2 client shared by all price requests
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        timeout=10.0,
+        limits=httpx.Limits(max_keepalive_connections=10),
+        headers=_CMC_HEADERS,
+    )
+    try:
+        await bot_builder.bot.setWebhook(url=settings.webhook_domain)
+        async with bot_builder:
+            await bot_builder.start()
+            yield
+            await bot_builder.stop()
+            await bot_builder.bot.send_message(chat_id=OWNER_ID, text="✅ Уведомления активны!")
+    finally:
+        await app.state.http.aclose()
+
 
 
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
-app = FastAPI(lifespan=lifespan)
+# All handlers react to message text only; anything else is acknowledged unparsed
+_TEXT_UPDATE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post")
 
 
 @app.post("/")
 async def process_update(request: Request):
-    """ Handles incoming Telegram updates and processes them with the bot. """
-    message = await request.json()
+    """ Acknowledges incoming Telegram updates and queues them for the bot's update processor. """
+    message = orjson.loads(await request.body())
+    if not any((message.get(key) or {}).get("text") for key in _TEXT_UPDATE_KEYS):
+        return Response(status_code=HTTPStatus.OK)
+
     update = Update.de_json(data=message, bot=bot_builder.bot)
-    await bot_builder.process_update(update)
+    # The queue is drained by Application.start(), which applies concurrent_updates
+    await bot_builder.update_queue.put(update)
     return Response(status_code=HTTPStatus.OK)
 
 
@@ -52,99 +123,143 @@ async def start(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     global OWNER_ID
     OWNER_ID = update.effective_chat.id
 
-    reply = (
-        "Привет, брат 🤝 Я готов к бою!\n\nДоступные команды:\n"
-        "/портфель — показать активы\n"
-        "/рынок — анализ ситуации\n"
-        "/нфт — NFT-пульс"
-    )
-    await update.message.reply_text(reply)
+    await update.message.reply_text(_START_REPLY)
     await bot_builder.bot.send_message(chat_id=OWNER_ID, text="✅ Уведомления активны!")
 
     print(f"🔐 chat_id: {update.effective_chat.id}")
 
 
 
+def _read_portfolio() -> dict:
+    with open(PORTFOLIO_PATH, "rb") as f:
+        data = orjson.loads(f.read())
+    if not isinstance(data, dict) or not all(isinstance(info, dict) for info in data.values()):
+        raise ValueError(f"{PORTFOLIO_PATH}: ожидается объект вида {{актив: {{...}}}}")
+    return data
+
+
+async def load_portfolio() -> dict:
+    """ Возвращает портфель из кэша, перечитывая файл только если он изменился """
+    mtime = os.stat(PORTFOLIO_PATH).st_mtime_ns
+    if _PORTFOLIO_CACHE["data"] is None or mtime != _PORTFOLIO_CACHE["mtime"]:
+        _PORTFOLIO_CACHE["data"] = await asyncio.to_thread(_read_portfolio)
+        _PORTFOLIO_CACHE["mtime"] = mtime
+        _PORTFOLIO_CACHE["rendered"] = None
+    return _PORTFOLIO_CACHE["data"]
+
+
+def render_portfolio(data: dict) -> str:
+    parts = ["📊 Портфель:"]
+    for key, info in data.items():
+        if key == "USDT":
+            parts.append(f"USDT (Bybit): ${info['amount']} — стейкинг {info['staking']}%")
+        elif key == "NFT":
+            parts.append(f"NFT: 🎴 {info['name']} (вход: {info['buy_floor_sol']} SOL)")
+        else:
+            parts.append(f"{key}: {info['amount']} — куплено на ${info['buy_usd']}")
+    return "\n".join(parts)
+
+
 async def portfolio(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
     """ Показывает портфель инвестиций """
     try:
-        with open("portfolio.json", "r") as f:
-            data = json.load(f)
-
-        reply = "📊 Портфель:\n"
-        for key, info in data.items():
-            if key == "USDT":
-                reply += f"USDT (Bybit): ${info['amount']} — стейкинг {info['staking']}%\n"
-            elif key == "NFT":
-                reply += f"NFT: 🎴 {info['name']} (вход: {info['buy_floor_sol']} SOL)\n"
-            else:
-                reply += f"{key}: {info['amount']} — куплено на ${info['buy_usd']}\n"
+        data = await load_portfolio()
+        if _PORTFOLIO_CACHE["rendered"] is None:
+            _PORTFOLIO_CACHE["rendered"] = render_portfolio(data)
 
-        await update.message.reply_text(reply)
-    except Exception as e:
+        await update.message.reply_text(_PORTFOLIO_CACHE["rendered"])
+    except (OSError, ValueError, KeyError, TypeError):
+        logger.exception("Ошибка при чтении портфеля")
         await update.message.reply_text("Ошибка при чтении портфеля.")
 
 
 async def get_prices():
+    """ Возвращает цены из кэша; параллельные вызовы ждут один общий запрос """
+    if _PRICE_CACHE["data"] and time.monotonic() - _PRICE_CACHE["ts"] < PRICE_TTL:
+        return _PRICE_CACHE["data"]
+
+    # Все ожидающие получают результат одного и того же запроса, в том числе неудачный
+    if _PRICE_CACHE["task"] is None:
+        _PRICE_CACHE["task"] = asyncio.create_task(_refresh_prices())
+    return await asyncio.shield(_PRICE_CACHE["task"])
+
+
+async def _refresh_prices():
+    try:
+        prices = await _fetch_prices()
+        if prices:
+            _PRICE_CACHE["data"] = prices
+            _PRICE_CACHE["ts"] = time.monotonic()
+        return prices
+    finally:
+        _PRICE_CACHE["task"] = None
+
+
+async def _fetch_prices():
     url = "https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest"
-    headers = {
-        "Accepts": "application/json",
-        "X-CMC_PRO_API_KEY": os.getenv("COINMARKETCAP_API_KEY")
-    }
-    symbols = ["BTC", "ETH", "SOL", "ARB", "TON"]
     params = {
-        "symbol": ",".join(symbols),
+        "symbol": ",".join(SYMBOLS),
         "convert": "USD"
     }
 
+    client = getattr(app.state, "http", None)
+    if client is None:
+        logger.error("Ошибка в get_prices: HTTP-клиент ещё не создан")
+        return None
+
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, params=params, headers=headers)
-            response.raise_for_status()
-            data = response.json()["data"]
-
-            return {
-                "BTC": round(data["BTC"]["quote"]["USD"]["price"], 2),
-                "ETH": round(data["ETH"]["quote"]["USD"]["price"], 2),
-                "SOL": round(data["SOL"]["quote"]["USD"]["price"], 2),
-                "ARB": round(data["ARB"]["quote"]["USD"]["price"], 2),
-                "TON": round(data["TON"]["quote"]["USD"]["price"], 2),
-            }
-    except Exception as e:
-        print(f"Ошибка в get_prices: {e}")
+        response = await client.get(url, params=params)
+        response.raise_for_status()
+        data = response.json()["data"]
+
+        return {s: round(data[s]["quote"]["USD"]["price"], 2) for s in SYMBOLS}
+    except (httpx.HTTPError, ValueError, KeyError):
+        logger.exception("Ошибка в get_prices")
         return None
 
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
 def calculate_profit(prices, portfolio):
-    result = []
+    tokens, amounts, buys, current = [], [], [], []
     for token, info in portfolio.items():
         if token not in prices:
             continue
 
-        current_price = prices[token]
         amount = info.get("amount", 0)
         buy_usd = info.get("buy_usd", 0)
 
+        # np.array молча превращает null в nan и принимает строки, поэтому проверяем сами
+        if not (_is_number(amount) and _is_number(buy_usd)):
+            raise TypeError(f"{token}: amount и buy_usd должны быть числами")
+
         if amount == 0 or buy_usd == 0:
             continue
 
-        current_value = amount * current_price
-        percent = round(((current_value - buy_usd) / buy_usd) * 100, 2)
-        arrow = "📈" if percent > 0 else "📉"
-        result.append(f"{token}: {percent:+.2f}% {arrow}")
-    return result
+        tokens.append(token)
+        amounts.append(amount)
+        buys.append(buy_usd)
+        current.append(prices[token])
+
+    if not tokens:
+        return []
+
+    # Доходность считается одной векторной операцией по всем активам
+    buy = np.array(buys, dtype=np.float64)
+    current_value = np.array(amounts, dtype=np.float64) * np.array(current, dtype=np.float64)
+    percents = np.round((current_value - buy) / buy * 100, 2)
+
+    return [
+        f"{token}: {percent:+.2f}% {'📈' if percent > 0 else '📉'}"
+        for token, percent in zip(tokens, percents.tolist())
+    ]
 
 async def market(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает текущие цены на основные активы"""
     prices = await get_prices()
     if prices:
-        reply = (
-            f"📊 Актуальные курсы:\n"
-            f"BTC: ${prices['BTC']}\n"
-            f"ETH: ${prices['ETH']}\n"
-            f"SOL: ${prices['SOL']}\n"
-            f"ARB: ${prices['ARB']}\n"
-            f"TON: ${prices['TON']}"
-        )
+        reply = _MARKET_TEMPLATE.format_map(prices)
     else:
         reply = "❌ Не удалось получить цены с CoinGecko."
 
@@ -152,10 +267,8 @@ async def market(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def profit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        with open("portfolio.json", "r") as f:
-            portfolio = json.load(f)
-
-        prices = await get_prices()
+        # Файл и цены не зависят друг от друга — загружаем параллельно
+        portfolio, prices = await asyncio.gather(load_portfolio(), get_prices())
 
         if not prices:
             await update.message.reply_text("❌ Не удалось получить цены.")
@@ -165,32 +278,47 @@ async def profit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         reply = "💰 Доходность портфеля:\n\n" + "\n".join(lines)
         await update.message.reply_text(reply)
 
-    except Exception as e:
+    except (OSError, ValueError, TypeError):
+        logger.exception("Ошибка в /профит")
         await update.message.reply_text("⚠️ Ошибка при расчёте доходности.")
-        print(f"Ошибка в /доход: {e}")
 
 
 
-async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = update.message.text.lower()
+async def nft_reply(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(_NFT_REPLY)
 
-    if text == "/портфель":
-        await portfolio(update, context)
-    elif text == "/рынок":
-         await market(update, context)
-    elif text == "/профит":
-         await profit(update, context)
-    elif text == "/нфт":
-        await update.message.reply_text("🖼 NFT-пульс: VALA в портфеле. Следим за Rogues Dead")
-    else:
-        reply = "🤔 Брат, не понял 🧠 Попробуй: /портфель, /рынок или /нфт"
-        await update.message.reply_text(reply)
+
+# Telegram не размечает кириллические команды как bot_command, и CommandHandler их не принимает,
+# поэтому они регистрируются через PrefixHandler: совпадение ищется по первому слову в множестве
+_FEATURE_COMMANDS = {
+    "portfolio": ("портфель", "показать активы", portfolio),
+    "market": ("рынок", "анализ ситуации", market),
+    "profit": ("профит", "доходность портфеля", profit),
+}
+
+# Подсказки перечисляют только включённые команды
+_ENABLED_COMMANDS = [
+    (alias, description)
+    for feature, (alias, description, _) in _FEATURE_COMMANDS.items()
+    if feature in settings.features
+] + [("нфт", "NFT-пульс")]
+_START_REPLY = "Привет, брат 🤝 Я готов к бою!\n\nДоступные команды:\n" + "\n".join(
+    f"/{alias} — {description}" for alias, description in _ENABLED_COMMANDS
+)
+_hints = [f"/{alias}" for alias, _ in _ENABLED_COMMANDS]
+_FALLBACK_REPLY = "🤔 Брат, не понял 🧠 Попробуй: " + (
+    f"{', '.join(_hints[:-1])} или {_hints[-1]}" if len(_hints) > 1 else _hints[0]
+)
 
 
+async def echo(update: Update, _: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(_FALLBACK_REPLY)
 
 
 bot_builder.add_handler(CommandHandler(command="start", callback=start))
-bot_builder.add_handler(CommandHandler("portfolio", portfolio))
-bot_builder.add_handler(CommandHandler("market", market))
-bot_builder.add_handler(CommandHandler("profit", profit))
+for feature, (alias, _, handler) in _FEATURE_COMMANDS.items():
+    if feature in settings.features:
+        bot_builder.add_handler(CommandHandler(feature, handler))
+        bot_builder.add_handler(PrefixHandler("/", alias, handler))
+bot_builder.add_handler(PrefixHandler("/", "нфт", nft_reply))
 bot_builder.add_handler(MessageHandler(filters=filters.TEXT & ~filters.COMMAND, callback=echo))